@@ -1,10 +1,17 @@
 ﻿import argparse
 import bz2
+import io
 import json
+import mmap
 import os
 import pickle
+import queue
 import re
+import shutil
+import threading
 from collections import Counter
+from sys import intern
+from multiprocessing import Pool
 from xml.etree import ElementTree
 
 from inverted_index_gcp import InvertedIndex
@@ -12,15 +19,93 @@ from inverted_index_gcp import InvertedIndex
 try:
     import mwparserfromhell as mwp
     mwp.definitions.INVISIBLE_TAGS.append("ref")
-    # Strip MediaWiki markup from text when parser is available.
-    # Returns plain text for tokenization.
-    def _clean_text(text):
+    # Full-AST wikitext stripping; precise, but by far the slowest step per page.
+    # Kept behind the --accurate flag.
+    def _clean_text_accurate(text):
         return mwp.parse(text or "").strip_code()
 except Exception:
-    # Fallback when mwparserfromhell is unavailable.
-    # Returns raw text (or empty string) unchanged.
-    def _clean_text(text):
-        return text or ""
+    _clean_text_accurate = None
+
+# Lossy wikitext stripping with a few precompiled regex passes. BM25 only needs
+# a bag of alphanumeric tokens, so dropping markup imprecisely is fine and
+# avoids building a full wikitext AST per page. Everything anchored on "<"
+# (comments, refs, other tags) is one ordered alternation, so those three
+# stripping passes cost a single scan of the body.
+_MARKUP_RE = re.compile(r"<!--.*?-->|<ref[^>]*?/>|<ref[^>]*?>.*?</ref>|<[^>]+>", re.DOTALL)
+_TMPL_RE = re.compile(r"\{\{[^{}]*\}\}")
+_LINK_RE = re.compile(r"\[\[(?:[^|\]]*\|)?([^\]]*)\]\]")
+
+
+def _clean_text_fast(text):
+    # Strip comments/refs/tags, then templates, then links.
+    # Returns plain-ish text for tokenization.
+    text = _MARKUP_RE.sub(" ", text or "")
+    # Templates nest; peel them inside-out up to a fixed depth.
+    for _ in range(4):
+        text, n = _TMPL_RE.subn(" ", text)
+        if not n:
+            break
+    return _LINK_RE.sub(r"\1", text)
+
+
+_clean_text = _clean_text_fast
+
+
+def _set_clean_mode(accurate):
+    # Pick the page cleaner for this process. Doubles as the Pool initializer
+    # so workers use the same cleaner as the parent.
+    global _clean_text
+    if accurate and _clean_text_accurate is not None:
+        _clean_text = _clean_text_accurate
+    else:
+        _clean_text = _clean_text_fast
+
+try:
+    # Optional: decompresses bz2 blocks on all cores instead of one.
+    import indexed_bzip2
+except Exception:
+    indexed_bzip2 = None
+
+try:
+    # Optional: C XML parser, much faster than the stdlib expat wrapper.
+    from lxml import etree as lxml_etree
+except Exception:
+    lxml_etree = None
+
+try:
+    # Optional: C JSON parser, several times faster than the stdlib on load.
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    # Optional: compresses the pickled metadata files on disk.
+    import zstandard
+except Exception:
+    zstandard = None
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _dump_pickle(obj, path):
+    # Pickle to disk, zstd-compressed when zstandard is installed.
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    if zstandard is not None:
+        data = zstandard.ZstdCompressor().compress(data)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _load_pickle(path):
+    # Load a pickle written by _dump_pickle, sniffing for zstd framing so
+    # plain pickles from older runs keep loading.
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd-compressed but zstandard is not installed")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return pickle.loads(data)
 
 WORD_RE = re.compile(r"[A-Za-z0-9]+")
 
@@ -30,44 +115,182 @@ def simple_tokenize(text):
     return [t.lower() for t in WORD_RE.findall(text)]
 
 
-def page_iter(wiki_file):
-    # Stream pages from a Wikipedia XML dump.
-    # Yields (wiki_id, title, body) for article pages only.
-    with bz2.open(wiki_file, "rt", encoding="utf-8", errors="ignore") as f_in:
-        elems = (elem for _, elem in ElementTree.iterparse(f_in, events=("end",)))
-        elem = next(elems)
-        m = re.match(r"^{(http://www\.mediawiki\.org/xml/export-.*?)}", elem.tag)
-        if m is None:
+# Maps every non-alphanumeric byte to a space. Multi-byte UTF-8 sequences all
+# map to separators, which matches WORD_RE's ASCII-only tokens.
+_ALNUM_TRANS = bytes(b if 48 <= b <= 57 or 65 <= b <= 90 or 97 <= b <= 122 else 0x20
+                     for b in range(256))
+
+
+def tokenize_counter(text):
+    # Tokenize and count without a per-character Python loop: translate, lower,
+    # and split all run in CPython's C string routines, and duplicate tokens
+    # collapse in the Counter before the (ASCII-only) decode back to str.
+    # Interning collapses the many repeats of each term across pages to a single
+    # string object shared by df/term_total/posting dicts, and makes their key
+    # lookups pointer comparisons.
+    counts = Counter(text.encode("utf-8", "ignore").translate(_ALNUM_TRANS).lower().split())
+    return Counter({intern(tok.decode("ascii")): cnt for tok, cnt in counts.items()})
+
+
+def _open_dump(wiki_file):
+    # Open a dump as a binary stream. .bz2 files are decompressed on the fly,
+    # using indexed_bzip2's multi-core decoder when it is installed (bz2 blocks
+    # are independent, so the decode parallelizes while the stream stays
+    # sequential). Anything else is assumed to be pre-decompressed XML and is
+    # mmapped, so repeated runs read straight from the page cache.
+    if not wiki_file.endswith(".bz2"):
+        with open(wiki_file, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if indexed_bzip2 is not None:
+        return indexed_bzip2.open(wiki_file, parallelization=os.cpu_count())
+    return bz2.open(wiki_file, "rb")
+
+
+def decompress_dump(wiki_file, cache_path=None):
+    # One-time decompression of a .bz2 dump to plain XML alongside it, so
+    # iterative development runs can skip the bz2 decode entirely.
+    # Returns the path to the cached XML file.
+    if not wiki_file.endswith(".bz2"):
+        return wiki_file
+    if cache_path is None:
+        cache_path = wiki_file[:-len(".bz2")]
+    if not os.path.exists(cache_path):
+        tmp_path = cache_path + ".tmp"
+        with _open_dump(wiki_file) as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+        os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def _iterparse(f_in):
+    # Incremental start/end parsing over a binary stream, through lxml's C
+    # parser when it is installed and the stdlib otherwise.
+    if lxml_etree is not None:
+        return lxml_etree.iterparse(f_in, events=("start", "end"), recover=True)
+    if not isinstance(f_in, mmap.mmap):
+        # Lenient decoding for streams; mmap objects lack the io interface
+        # TextIOWrapper needs, and expat decodes their bytes directly.
+        f_in = io.TextIOWrapper(f_in, encoding="utf-8", errors="ignore")
+    return ElementTree.iterparse(f_in, events=("start", "end"))
+
+
+def page_iter(wiki_file, target_ids=None):
+    # Stream pages from a Wikipedia XML dump with a flat iterparse state machine.
+    # Yields (wiki_id, title, body) for article pages only; when `target_ids` is
+    # given, pages outside it are skipped before their revision text is read.
+    with _open_dump(wiki_file) as f_in:
+        context = _iterparse(f_in)
+        event, root = next(context)
+        m = re.match(r"^{http://www\.mediawiki\.org/xml/export-.*?}", root.tag)
+        if event != "start" or m is None:
             raise ValueError("Malformed MediaWiki dump")
-        ns = {"ns": m.group(1)}
-        page_tag = ElementTree.QName(ns["ns"], "page").text
-        for elem in elems:
-            if elem.tag != page_tag:
+        # Track depth instead of building/searching per-page subtrees. Fields of
+        # interest all sit at fixed depths: page children at 3, revision text at 4.
+        depth = 1
+        skip = True
+        wiki_id = title = body = None
+        for event, elem in context:
+            if event == "start":
+                depth += 1
+                if depth == 2 and elem.tag.endswith("}page"):
+                    skip = False
+                    wiki_id = title = body = None
                 continue
-            if elem.find("./ns:redirect", ns) is not None or elem.find("./ns:ns", ns).text != "0":
+            # "end" event: `depth` is still the depth of `elem`.
+            if depth == 3:
+                tag = elem.tag.rpartition("}")[2]
+                if tag == "ns":
+                    skip = skip or elem.text != "0"
+                elif tag == "redirect":
+                    skip = True
+                elif not skip:
+                    if tag == "title":
+                        title = elem.text
+                    elif tag == "id" and wiki_id is None:
+                        wiki_id = elem.text
+                        # The page id closes before <revision> opens, so pages
+                        # outside the target set never materialize their body.
+                        if target_ids is not None:
+                            try:
+                                if int(wiki_id) not in target_ids:
+                                    skip = True
+                            except ValueError:
+                                skip = True
+            elif depth == 4 and not skip and elem.tag.endswith("}text"):
+                body = elem.text
+            elif depth == 2 and elem.tag.endswith("}page"):
+                if not skip and wiki_id is not None:
+                    yield wiki_id, title, body
+                skip = True
                 elem.clear()
-                continue
-            wiki_id = elem.find("./ns:id", ns).text
-            title = elem.find("./ns:title", ns).text
-            body = elem.find("./ns:revision/ns:text", ns).text
-            yield wiki_id, title, body
-            elem.clear()
+                # iterparse keeps finished pages attached to the root; drop them
+                # so memory stays flat across the dump.
+                root.clear()
+            depth -= 1
+
+
+_PREFETCH_DONE = object()
+
+
+def _prefetch(iterable, maxsize=64):
+    # Drain `iterable` on a background thread, handing items over a bounded
+    # queue. Decompression + XML parsing then overlap the tokenize/merge work
+    # (or pool dispatch) running in the consuming thread.
+    q = queue.Queue(maxsize)
+
+    def drain():
+        try:
+            for item in iterable:
+                q.put(item)
+            q.put(_PREFETCH_DONE)
+        except BaseException as exc:
+            q.put(exc)
+
+    threading.Thread(target=drain, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is _PREFETCH_DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def _process_page(args):
+    # Worker-side half of build(): clean + tokenize + count one page.
+    # Returns (doc_id, title, token counts, doc length) for merging in the parent.
+    doc_id, title, body = args
+    w2cnt = tokenize_counter(_clean_text(body))
+    return doc_id, title, w2cnt, sum(w2cnt.values())
 
 
 class FilteredBodyIndexBuilder:
     """Build a body inverted index for only the doc IDs in queries_train.json."""
-    def __init__(self, wiki_file, queries_json, out_dir, tokenizer=None):
+    def __init__(self, wiki_file, queries_json, out_dir, tokenizer=None, workers=1,
+                 accurate=False):
         self.wiki_file = wiki_file
         self.queries_json = queries_json
         self.out_dir = out_dir
         self.tokenizer = tokenizer or simple_tokenize
+        # Custom tokenizers still return token lists; the default path counts
+        # matches directly without materializing one.
+        if tokenizer is None:
+            self._count_tokens = tokenize_counter
+        else:
+            self._count_tokens = lambda text: Counter(tokenizer(text))
+        self.workers = workers or 1
+        self.accurate = accurate
+        self._target_ids = None
 
     def load_query_doc_ids(self):
         # Load all target wiki IDs from the training queries file.
-        # Returns a set of integer wiki IDs.
+        # Returns a frozenset of integer wiki IDs, parsed at most once.
         """Load all wiki IDs referenced by queries_train.json."""
-        with open(self.queries_json, "rt", encoding="utf-8") as f:
-            queries = json.load(f)
+        if self._target_ids is not None:
+            return self._target_ids
+        with open(self.queries_json, "rb") as f:
+            data = f.read()
+        queries = orjson.loads(data) if orjson is not None else json.loads(data)
         ids = set()
         for doc_ids in queries.values():
             for wid in doc_ids:
@@ -75,31 +298,45 @@ class FilteredBodyIndexBuilder:
                     ids.add(int(wid))
                 except ValueError:
                     continue
-        return ids
+        self._target_ids = frozenset(ids)
+        return self._target_ids
 
     def build(self):
         # Build an in-memory body index for only the target doc IDs.
         # Returns (index, doc_len, id_title) for later writing.
         """Parse the dump, filter to target IDs, and build the in-memory index."""
         target_ids = self.load_query_doc_ids()
+        _set_clean_mode(self.accurate)
         index = InvertedIndex()
         doc_len = {}
         id_title = {}
 
-        for wiki_id, title, body in page_iter(self.wiki_file):
-            try:
-                doc_id = int(wiki_id)
-            except ValueError:
-                continue
-            if doc_id not in target_ids:
-                continue
-            text = _clean_text(body)
-            tokens = self.tokenizer(text)
-            if not tokens:
-                continue
-            index.add_doc(doc_id, tokens)
-            doc_len[doc_id] = len(tokens)
-            id_title[doc_id] = title
+        pages = _prefetch((int(wiki_id), title, body)
+                          for wiki_id, title, body in page_iter(self.wiki_file, target_ids))
+        if self.workers > 1:
+            # Cleaning + tokenization is the compute-bound part, so fan it out to
+            # a worker pool and merge the per-doc counts sequentially here; the
+            # index itself is only touched by the parent process.
+            with Pool(self.workers, initializer=_set_clean_mode,
+                      initargs=(self.accurate,), maxtasksperchild=500) as pool:
+                results = pool.imap_unordered(_process_page, pages, chunksize=32)
+                for doc_id, title, w2cnt, length in results:
+                    if not w2cnt:
+                        continue
+                    # Unpickled counters carry fresh string objects; re-intern
+                    # them so the long-lived index dicts share one per term.
+                    w2cnt = Counter({intern(w): cnt for w, cnt in w2cnt.items()})
+                    index.add_doc_counter(doc_id, w2cnt)
+                    doc_len[doc_id] = length
+                    id_title[doc_id] = title
+        else:
+            for doc_id, title, body in pages:
+                w2cnt = self._count_tokens(_clean_text(body))
+                if not w2cnt:
+                    continue
+                index.add_doc_counter(doc_id, w2cnt)
+                doc_len[doc_id] = sum(w2cnt.values())
+                id_title[doc_id] = title
         return index, doc_len, id_title
 
     def write(self, index, doc_len, id_title):
@@ -108,20 +345,15 @@ class FilteredBodyIndexBuilder:
         """Write posting files, index metadata, and doc metadata to disk."""
         os.makedirs(self.out_dir, exist_ok=True)
         list_w_pl = sorted(index._posting_list.items())
-        bucket_id = InvertedIndex.write_a_posting_list(("body", list_w_pl), self.out_dir)
-        posting_locs_path = os.path.join(self.out_dir, f"{bucket_id}_posting_locs.pickle")
-        with open(posting_locs_path, "rb") as f:
-            posting_locs = pickle.load(f)
+        _, posting_locs = InvertedIndex.write_a_posting_list(("body", list_w_pl), self.out_dir)
         # Normalize to file basenames so read_a_posting_list doesn't double-join paths.
         for term, locs in posting_locs.items():
             posting_locs[term] = [(os.path.basename(fname), offset) for fname, offset in locs]
         index.posting_locs.update(posting_locs)
         index.write_index(self.out_dir, "body_index")
 
-        with open(os.path.join(self.out_dir, "doc_len.pkl"), "wb") as f:
-            pickle.dump(doc_len, f)
-        with open(os.path.join(self.out_dir, "id_title.pkl"), "wb") as f:
-            pickle.dump(id_title, f)
+        _dump_pickle(doc_len, os.path.join(self.out_dir, "doc_len.pkl"))
+        _dump_pickle(id_title, os.path.join(self.out_dir, "id_title.pkl"))
 
 
 def main():
@@ -131,9 +363,17 @@ def main():
     parser.add_argument("--wiki", required=True, help="Path to Wikipedia .bz2 dump file")
     parser.add_argument("--queries", required=True, help="Path to queries_train.json")
     parser.add_argument("--out", required=True, help="Output directory for index files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Worker processes for cleaning/tokenization (1 disables the pool)")
+    parser.add_argument("--accurate", action="store_true",
+                        help="Strip wikitext with mwparserfromhell instead of the fast regex cleaner")
+    parser.add_argument("--cache-xml", action="store_true",
+                        help="Decompress the dump to a .xml next to it once and reuse it on later runs")
     args = parser.parse_args()
 
-    builder = FilteredBodyIndexBuilder(args.wiki, args.queries, args.out)
+    wiki_file = decompress_dump(args.wiki) if args.cache_xml else args.wiki
+    builder = FilteredBodyIndexBuilder(wiki_file, args.queries, args.out,
+                                       workers=args.workers, accurate=args.accurate)
     index, doc_len, id_title = builder.build()
     builder.write(index, doc_len, id_title)
     print(f"Indexed {len(id_title)} docs into {args.out}")
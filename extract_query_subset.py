@@ -7,13 +7,20 @@ import threading
 import time
 
 import gcsfs
-import pyarrow.parquet as pq
+import pyarrow as pa
+import pyarrow.dataset as ds
 from google.oauth2.credentials import Credentials
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
 
 def load_query_ids(path):
-    with open(path, "rt", encoding="utf-8") as f:
-        queries = json.load(f)
+    with open(path, "rb") as f:
+        data = f.read()
+    queries = orjson.loads(data) if orjson is not None else json.loads(data)
     ids = set()
     for doc_ids in queries.values():
         for wid in doc_ids:
@@ -42,6 +49,8 @@ def get_gcsfs_with_gcloud_token():
 
 
 def normalize_value(value):
+    # Per-value fallback decoder; only used when the columnar cast fails on
+    # non-UTF-8 bytes, since errors="ignore" has no Arrow cast equivalent.
     if isinstance(value, bytes):
         return value.decode("utf-8", errors="ignore")
     if isinstance(value, list):
@@ -51,6 +60,45 @@ def normalize_value(value):
     return value
 
 
+def _dump_row(row):
+    # Serialize one output row to UTF-8 bytes, preferring orjson's C encoder.
+    if orjson is not None:
+        return orjson.dumps(row)
+    return json.dumps(row, ensure_ascii=False).encode("utf-8")
+
+
+def _decoded_type(dtype):
+    # Recursively rewrite a type so every binary leaf becomes a utf8 string,
+    # descending through list/map/struct nesting.
+    if pa.types.is_binary(dtype) or pa.types.is_fixed_size_binary(dtype):
+        return pa.string()
+    if pa.types.is_large_binary(dtype):
+        return pa.large_string()
+    if pa.types.is_list(dtype):
+        return pa.list_(_decoded_type(dtype.value_type))
+    if pa.types.is_large_list(dtype):
+        return pa.large_list(_decoded_type(dtype.value_type))
+    if pa.types.is_map(dtype):
+        return pa.map_(_decoded_type(dtype.key_type), _decoded_type(dtype.item_type))
+    if pa.types.is_struct(dtype):
+        return pa.struct([field.with_type(_decoded_type(field.type)) for field in dtype])
+    return dtype
+
+
+def decode_binary_columns(table):
+    # One-time schema rewrite: cast every binary leaf (nested ones included) to
+    # utf8 so to_pylist() yields str throughout. Returns (table, fully_decoded);
+    # fully_decoded is False only when a column holds non-UTF-8 bytes.
+    schema = pa.schema([field.with_type(_decoded_type(field.type)) for field in table.schema])
+    if schema.equals(table.schema):
+        return table, True
+    try:
+        return table.cast(schema), True
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # Non-UTF-8 bytes somewhere; fall back to per-row decoding.
+        return table, False
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract articles referenced by queries_train.json from GCS parquet files.")
     parser.add_argument("--queries", default="queries_train.json", help="Path to queries JSON file")
@@ -74,11 +122,11 @@ def main():
     last_file = None
     if args.resume:
         if os.path.exists(args.out):
-            with open(args.out, "rt", encoding="utf-8") as f:
+            with open(args.out, "rb") as f:
                 for line in f:
                     try:
-                        row = json.loads(line)
-                    except json.JSONDecodeError:
+                        row = orjson.loads(line) if orjson is not None else json.loads(line)
+                    except ValueError:
                         continue
                     try:
                         found_ids.add(int(row.get("id")))
@@ -127,18 +175,30 @@ def main():
     hb_thread = threading.Thread(target=heartbeat, daemon=True)
     hb_thread.start()
 
-    mode = "at" if args.resume else "wt"
-    with open(args.out, mode, encoding="utf-8") as f:
-        for idx, file_path in enumerate(files[start_idx:], start=start_idx + 1):
+    # One dataset over all pending files: schemas and file metadata are resolved
+    # once up front instead of re-opening every file with pq.read_table.
+    dataset = ds.dataset(files[start_idx:], format="parquet", filesystem=fs)
+
+    # Build the id filter once: Arrow hashes the value set a single time, versus
+    # re-sorting `remaining` and rebuilding the expression for every file.
+    # `remaining` is still tracked in Python for the early-exit check, and
+    # already-found ids that re-match are deduplicated at write time.
+    id_filter = ds.field("id").isin(pa.array(sorted(remaining), type=pa.int64()))
+
+    # Binary writes with a wide buffer: rows go out as pre-encoded bytes in one
+    # write each, with no TextIOWrapper encode step in between.
+    mode = "ab" if args.resume else "wb"
+    with open(args.out, mode, buffering=1024 * 1024) as f:
+        for idx, fragment in enumerate(dataset.get_fragments(), start=start_idx + 1):
             if not remaining:
                 break
+            file_path = fragment.path
             print(f"Scanning {idx}/{len(files)}: {file_path} (remaining IDs: {len(remaining)})")
             try:
                 t0 = time.time()
-                table = pq.read_table(
-                    file_path,
-                    filters=[("id", "in", sorted(remaining))],
-                    filesystem=fs,
+                table = fragment.to_table(
+                    schema=dataset.schema,
+                    filter=id_filter,
                     use_threads=True,
                 )
             except Exception as exc:
@@ -154,19 +214,22 @@ def main():
                     progress["last_file"] = file_path
                 continue
 
+            table, fully_decoded = decode_binary_columns(table)
             rows = table.to_pylist()
             for row in rows:
-                row = normalize_value(row)
+                if not fully_decoded:
+                    row = normalize_value(row)
                 if "id" in row:
                     try:
                         rid = int(row["id"])
-                        found_ids.add(rid)
-                        if rid in remaining:
-                            remaining.remove(rid)
                     except (TypeError, ValueError):
-                        pass
-                f.write(json.dumps(row, ensure_ascii=True))
-                f.write("\n")
+                        rid = None
+                    if rid is not None:
+                        if rid in found_ids:
+                            continue
+                        found_ids.add(rid)
+                        remaining.discard(rid)
+                f.write(_dump_row(row) + b"\n")
                 written += 1
             with open(args.state, "wt", encoding="utf-8") as state_f:
                 json.dump({"last_file": file_path}, state_f)
@@ -13,6 +13,11 @@ from google.cloud import storage
 from collections import defaultdict
 from contextlib import closing
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 PROJECT_ID = 'YOUR-PROJECT-ID-HERE'
 def get_bucket(bucket_name):
     return storage.Client(PROJECT_ID).bucket(bucket_name)
@@ -119,11 +124,19 @@ class InvertedIndex:
             the tf of tokens, then update the index (in memory, no storage 
             side-effects).
         """
-        w2cnt = Counter(tokens)
+        self.add_doc_counter(doc_id, Counter(tokens))
+
+    def add_doc_counter(self, doc_id, w2cnt):
+        """ Same as `add_doc` but takes pre-computed token counts, so callers
+            that already hold a Counter (e.g. pool workers) skip a recount.
+        """
+        # Both Counter.update calls run in C (_count_elements); the only Python
+        # loop left per document is the posting append.
         self.term_total.update(w2cnt)
+        self.df.update(w2cnt.keys())
+        posting_list = self._posting_list
         for w, cnt in w2cnt.items():
-            self.df[w] = self.df.get(w, 0) + 1
-            self._posting_list[w].append((doc_id, cnt))
+            posting_list[w].append((doc_id, cnt))
 
     def write_index(self, base_dir, name, bucket_name=None):
         """ Write the in-memory index to disk. Results in the file: 
@@ -179,10 +192,18 @@ class InvertedIndex:
         bucket_id, list_w_pl = b_w_pl
         
         with closing(MultiFileWriter(base_dir, bucket_id, bucket_name)) as writer:
-            for w, pl in list_w_pl: 
+            for w, pl in list_w_pl:
                 # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                              for doc_id, tf in pl])
+                if np is not None and pl:
+                    # Pack the whole posting list in one vectorized pass: each
+                    # posting becomes a big-endian u64 whose 6 low-order bytes
+                    # are exactly the TUPLE_SIZE on-disk encoding.
+                    a = np.asarray(pl, dtype=np.uint64)
+                    packed = (a[:, 0] << np.uint64(16)) | (a[:, 1] & np.uint64(TF_MASK))
+                    b = packed.astype('>u8').view(np.uint8).reshape(-1, 8)[:, 8 - TUPLE_SIZE:].tobytes()
+                else:
+                    b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
+                                  for doc_id, tf in pl])
                 # write to file(s)
                 locs = writer.write(b)
                 # save file locations to index
@@ -191,7 +212,9 @@ class InvertedIndex:
             bucket = None if bucket_name is None else get_bucket(bucket_name)
             with _open(path, 'wb', bucket) as f:
                 pickle.dump(posting_locs, f)
-        return bucket_id
+        # hand the locations back as well, so local callers don't need to load
+        # the pickle they just wrote.
+        return bucket_id, posting_locs
 
 
     @staticmethod
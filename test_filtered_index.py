@@ -1,6 +1,6 @@
 ﻿import json
 import os
-import pickle
+from build_filtered_body_index import _load_pickle
 from inverted_index_gcp import InvertedIndex
 
 out_dir = "index_filtered"
@@ -13,10 +13,8 @@ if missing:
 with open("queries_train.json", "rt", encoding="utf-8") as f:
     queries = json.load(f)
 
-with open(os.path.join(out_dir, "doc_len.pkl"), "rb") as f:
-    doc_len = pickle.load(f)
-with open(os.path.join(out_dir, "id_title.pkl"), "rb") as f:
-    id_title = pickle.load(f)
+doc_len = _load_pickle(os.path.join(out_dir, "doc_len.pkl"))
+id_title = _load_pickle(os.path.join(out_dir, "id_title.pkl"))
 
 target_ids = set()
 for ids in queries.values():